@@ -1,68 +1,406 @@
 import pyaudio
-import wave
+import threading
+import time
+import tracemalloc
 import numpy as np
 import soundfile as sf
 from scipy import signal
 
-def record_audio(duration=5, sample_rate=48000, bit_depth=16):
-    """Record audio from microphone"""
-    p = pyaudio.PyAudio()
-    format = pyaudio.paInt16 if bit_depth == 16 else pyaudio.paInt8
-    
-    stream = p.open(
+# PyAudio sample format, NumPy dtype and soundfile subtype for each supported bit depth
+SAMPLE_FORMATS = {
+    8: (pyaudio.paInt8, np.int8, 'PCM_U8'),
+    16: (pyaudio.paInt16, np.int16, 'PCM_16'),
+}
+
+class RingBuffer:
+    """Preallocated single-producer/single-consumer ring buffer of audio frames"""
+
+    def __init__(self, capacity, dtype=np.int16, channels=1):
+        self.buffer = np.zeros((capacity, channels), dtype=dtype)
+        self.capacity = capacity
+        # Monotonic frame counters; only the producer moves write_pos and only the consumer moves read_pos
+        self.write_pos = 0
+        self.read_pos = 0
+        self.overruns = 0   # writes that did not fit completely
+        self.dropped = 0    # frames lost to those overruns
+        self.underruns = 0  # reads the consumer could not fill, counted by the consumer
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def available(self):
+        """Number of frames ready to be read"""
+        return self.write_pos - self.read_pos
+
+    def free(self):
+        """Number of frames that can be written without dropping data"""
+        return self.capacity - self.available()
+
+    def write(self, data):
+        """Copy frames into the buffer, dropping whatever does not fit (counted as an overrun)"""
+        n = len(data)
+        free = self.free()
+        if n > free:
+            self.overruns += 1
+            self.dropped += n - free
+            n = free
+        start = self.write_pos % self.capacity
+        first = min(n, self.capacity - start)
+        self.buffer[start:start + first] = data[:first]
+        self.buffer[:n - first] = data[first:n]
+        self.write_pos += n
+        with self.condition:
+            self.condition.notify_all()
+        return n
+
+    def read(self, out):
+        """Copy up to len(out) frames into out and return how many were copied"""
+        n = min(len(out), self.available())
+        start = self.read_pos % self.capacity
+        first = min(n, self.capacity - start)
+        out[:first] = self.buffer[start:start + first]
+        out[first:n] = self.buffer[:n - first]
+        self.read_pos += n
+        with self.condition:
+            self.condition.notify_all()
+        return n
+
+    def close(self):
+        """Mark the end of the data; wakes up anyone waiting on the buffer"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def wait_for_data(self, frames, timeout=None):
+        """Wait until at least `frames` frames can be read or the buffer is closed"""
+        with self.condition:
+            return self.condition.wait_for(lambda: self.available() >= frames or self.closed, timeout)
+
+    def wait_for_space(self, frames, timeout=None):
+        """Wait until at least `frames` frames can be written or the buffer is closed"""
+        with self.condition:
+            return self.condition.wait_for(lambda: self.free() >= frames or self.closed, timeout)
+
+class FileStream:
+    """Stand-in for a callback-mode PyAudio stream that reads from / writes to a sound file.
+
+    With realtime=False and the recorder's/player's RingBuffer passed as `ring`, callbacks
+    run as fast as the other side keeps up. An exception in the stream thread is re-raised
+    by stop_stream().
+    """
+
+    def __init__(self, filename, format=pyaudio.paInt16, channels=1, rate=48000, input=False,
+                 output=False, frames_per_buffer=1024, stream_callback=None, start=True,
+                 realtime=True, ring=None):
+        self.filename = filename
+        self.format = format
+        self.channels = channels
+        self.rate = rate
+        self.input = input
+        self.output = output
+        self.frames_per_buffer = frames_per_buffer
+        self.callback = stream_callback
+        self.realtime = realtime
+        self.ring = ring
+        self.frames = 0
+        self.callback_times = []
+        self.active = False
+        self.thread = None
+        self.error = None
+        if start:
+            self.start_stream()
+
+    def start_stream(self):
+        self.active = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop_stream(self):
+        self.active = False
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def close(self):
+        self.stop_stream()
+
+    def is_active(self):
+        return self.active
+
+    def _call(self, in_data, frame_count):
+        now = time.perf_counter()
+        time_info = {'input_buffer_adc_time': now, 'current_time': now, 'output_buffer_dac_time': now}
+        result = self.callback(in_data, frame_count, time_info, 0)
+        self.callback_times.append(time.perf_counter() - now)
+        return result
+
+    def _wait_for_ring(self):
+        """In non-realtime mode, block until the other side of the ring buffer has caught up"""
+        if self.realtime or self.ring is None:
+            return
+        wait = self.ring.wait_for_space if self.input else self.ring.wait_for_data
+        while self.active and not wait(self.frames_per_buffer, timeout=0.1):
+            pass
+
+    def _run(self):
+        try:
+            self._process()
+        except Exception as error:
+            self.error = error
+        finally:
+            self.active = False
+
+    def _process(self):
+        dtype = np.int8 if self.format == pyaudio.paInt8 else np.int16
+        period = self.frames_per_buffer / self.rate
+        deadline = time.perf_counter()
+        if self.input:
+            f = sf.SoundFile(self.filename)
+        else:
+            f = sf.SoundFile(self.filename, 'w', samplerate=self.rate, channels=self.channels,
+                             subtype='PCM_16')
+        with f:
+            while self.active:
+                self._wait_for_ring()
+                if self.input:
+                    data = f.read(self.frames_per_buffer, dtype='int16', always_2d=True)
+                    if len(data) == 0:
+                        break
+                    if dtype == np.int8:
+                        data = (data >> 8).astype(np.int8)
+                    # The last block of the file may be short; it is passed on as it is
+                    _, flag = self._call(data[:, :self.channels].tobytes(), len(data))
+                    self.frames += len(data)
+                    if len(data) < self.frames_per_buffer:
+                        break
+                else:
+                    out_data, flag = self._call(None, self.frames_per_buffer)
+                    samples = np.frombuffer(out_data, dtype=dtype).reshape(-1, self.channels)
+                    f.write(samples.astype(np.int16) * 256 if dtype == np.int8 else samples)
+                    self.frames += len(samples)
+                if flag != pyaudio.paContinue:
+                    break
+                if self.realtime:
+                    deadline += period
+                    time.sleep(max(0.0, deadline - time.perf_counter()))
+
+def record_audio_stream(filename, duration=5, sample_rate=48000, bit_depth=16,
+                        buffer_frames=65536, frames_per_buffer=1024, stream_factory=None, ring=None):
+    """Record audio through a stream callback into a ring buffer, streaming it straight to a WAV file.
+
+    Returns the number of frames written, ring buffer overruns and dropped frames,
+    host input overflows reported by PortAudio, and the elapsed time.
+    """
+    format, dtype, subtype = SAMPLE_FORMATS[bit_depth]
+    total_frames = int(sample_rate * duration)
+    if ring is None:
+        ring = RingBuffer(buffer_frames, dtype)
+    captured = 0
+    input_overflows = 0
+
+    def callback(in_data, frame_count, time_info, status):
+        nonlocal captured, input_overflows
+        if status & pyaudio.paInputOverflow:
+            input_overflows += 1
+        samples = np.frombuffer(in_data, dtype=dtype).reshape(-1, 1)[:total_frames - captured]
+        ring.write(samples)
+        # Count what the device delivered, not what fit, so drops do not stretch the recording
+        captured += len(samples)
+        if captured >= total_frames:
+            ring.close()
+            return (None, pyaudio.paComplete)
+        return (None, pyaudio.paContinue)
+
+    p = None
+    if stream_factory is None:
+        p = pyaudio.PyAudio()
+        stream_factory = p.open
+    stream = stream_factory(
         format=format,
         channels=1,
         rate=sample_rate,
         input=True,
-        frames_per_buffer=1024
+        frames_per_buffer=frames_per_buffer,
+        stream_callback=callback,
+        start=False
     )
 
     print("Recording...")
-    frames = []
-    for _ in range(0, int(sample_rate / 1024 * duration)):
-        data = stream.read(1024)
-        frames.append(data)
+    period = frames_per_buffer / sample_rate
+    block = np.empty((ring.capacity, 1), dtype=dtype)
+    written = 0
+    started = time.perf_counter()
+    with sf.SoundFile(filename, 'w', samplerate=sample_rate, channels=1, subtype=subtype) as f:
+        stream.start_stream()
+        while stream.is_active() or ring.available():
+            ring.wait_for_data(frames_per_buffer, timeout=period)
+            n = ring.read(block)
+            if n == 0:
+                continue
+            # soundfile has no signed 8-bit input type, so widen to int16 before writing
+            f.write(block[:n].astype(np.int16) * 256 if bit_depth == 8 else block[:n])
+            written += n
+    elapsed = time.perf_counter() - started
 
     stream.stop_stream()
     stream.close()
-    p.terminate()
-    
-    return frames, sample_rate, bit_depth
-
-def save_audio(frames, filename, sample_rate, bit_depth):
-    """Save audio to WAV file"""
-    p = pyaudio.PyAudio()
-    wf = wave.open(filename, 'wb')
-    wf.setnchannels(1)
-    wf.setsampwidth(p.get_sample_size(pyaudio.paInt16 if bit_depth == 16 else pyaudio.paInt8))
-    wf.setframerate(sample_rate)
-    wf.writeframes(b''.join(frames))
-    wf.close()
-    p.terminate()
-
-def play_audio(filename):
-    """Play audio from WAV file"""
-    p = pyaudio.PyAudio()
-    wf = wave.open(filename, 'rb')
-    
-    stream = p.open(
-        format=p.get_format_from_width(wf.getsampwidth()),
-        channels=wf.getnchannels(),
-        rate=wf.getframerate(),
-        output=True
-    )
+    if p is not None:
+        p.terminate()
+
+    return {'frames': written, 'overruns': ring.overruns, 'dropped': ring.dropped,
+            'input_overflows': input_overflows, 'elapsed': elapsed}
 
-    data = wf.readframes(1024)
-    while data:
-        stream.write(data)
-        data = wf.readframes(1024)
+def play_audio_stream(filename, buffer_frames=65536, frames_per_buffer=1024, stream_factory=None, ring=None):
+    """Play a sound file through a stream callback fed from a ring buffer.
+
+    Returns the number of frames played, ring buffer underruns, host output
+    underflows reported by PortAudio, and the elapsed time.
+    """
+    with sf.SoundFile(filename) as f:
+        channels = f.channels
+        sample_rate = f.samplerate
+        if ring is None:
+            ring = RingBuffer(buffer_frames, np.int16, channels)
+        out = np.zeros((frames_per_buffer, channels), dtype=np.int16)
+        output_underflows = 0
+
+        def callback(in_data, frame_count, time_info, status):
+            nonlocal out, output_underflows
+            if status & pyaudio.paOutputUnderflow:
+                output_underflows += 1
+            if frame_count > len(out):
+                out = np.zeros((frame_count, channels), dtype=np.int16)
+            # Check for the end of the file before reading, otherwise the last frames
+            # could be written and the buffer closed between the read and the check
+            done = ring.closed
+            n = ring.read(out[:frame_count])
+            if n < frame_count:
+                if done:
+                    return (out[:n].tobytes(), pyaudio.paComplete)
+                out[n:frame_count] = 0
+                ring.underruns += 1
+            return (out[:frame_count].tobytes(), pyaudio.paContinue)
+
+        p = None
+        if stream_factory is None:
+            p = pyaudio.PyAudio()
+            stream_factory = p.open
+        stream = stream_factory(
+            format=pyaudio.paInt16,
+            channels=channels,
+            rate=sample_rate,
+            output=True,
+            frames_per_buffer=frames_per_buffer,
+            stream_callback=callback,
+            start=False
+        )
+
+        period = frames_per_buffer / sample_rate
+        block = np.empty((frames_per_buffer, channels), dtype=np.int16)
+        started = time.perf_counter()
+        playing = False
+        while True:
+            data = f.read(frames_per_buffer, dtype='int16', always_2d=True, out=block)
+            if len(data) == 0:
+                break
+            if ring.free() < len(data) and not playing:
+                # The ring buffer is full, so the prefill is done and playback can start
+                stream.start_stream()
+                playing = True
+            # Give up once the stream has stopped on its own, nothing would drain the ring
+            while not ring.wait_for_space(len(data), timeout=period) and stream.is_active():
+                pass
+            if playing and not stream.is_active():
+                break
+            ring.write(data)
+        ring.close()
+        if not playing and ring.available():
+            stream.start_stream()
+        while stream.is_active():
+            time.sleep(period)
+        elapsed = time.perf_counter() - started
 
     stream.stop_stream()
     stream.close()
-    p.terminate()
-    wf.close()
+    if p is not None:
+        p.terminate()
+
+    return {'frames': ring.read_pos, 'underruns': ring.underruns,
+            'output_underflows': output_underflows, 'elapsed': elapsed}
+
+def quantize(data, bit_depth, dither=False, noise_shaping=False, rng=None, chunk_size=65536):
+    """Quantize float audio in [-1, 1) to the given bit depth (1-24), in place.
+
+    Works in chunks of chunk_size frames, so np.memmap arrays are fine; 1-bit is a sign quantizer (-1/+1).
+    """
+    if not 1 <= bit_depth <= 24:
+        raise ValueError("bit_depth must be between 1 and 24")
+    if not np.issubdtype(data.dtype, np.floating):
+        raise TypeError("quantize() needs a floating point array")
+    if rng is None:
+        rng = np.random.default_rng()
+
+    scale = float(2 ** (bit_depth - 1))
+    if bit_depth == 1:
+        low, high, step = -1.0, 1.0, 2.0
+    else:
+        low, high, step = -scale, scale - 1, 1.0
+    noise = None
+    if dither:
+        # Reused for every chunk instead of allocating two fresh random arrays each time;
+        # Generator.random() only fills float32/float64, other precisions get float64 noise
+        noise_dtype = data.dtype if data.dtype in (np.float32, np.float64) else np.float64
+        noise = np.empty((2,) + data[:chunk_size].shape, dtype=noise_dtype)
+    error = [0.0] * (data.shape[1] if data.ndim > 1 else 1)
+
+    for start in range(0, len(data), chunk_size):
+        chunk = data[start:start + chunk_size]
+        chunk *= scale
+        if dither:
+            a, b = noise[0, :len(chunk)], noise[1, :len(chunk)]
+            rng.random(out=a, dtype=noise.dtype)
+            rng.random(out=b, dtype=noise.dtype)
+            a -= b
+            if step != 1.0:
+                a *= step
+            chunk += a
+        if noise_shaping:
+            columns = chunk.reshape(len(chunk), -1)
+            for c in range(columns.shape[1]):
+                samples = columns[:, c].tolist()
+                e = error[c]
+                for i, x in enumerate(samples):
+                    v = x - e
+                    r = (1.0 if v >= 0 else -1.0) if bit_depth == 1 else round(v)
+                    # Feed back the rounding error only, not the clipping error, so
+                    # an over-range stretch cannot wind the error up without bound
+                    e = min(max(r - v, -step), step)
+                    samples[i] = min(max(r, low), high)
+                error[c] = e
+                columns[:, c] = samples
+        elif bit_depth == 1:
+            np.copysign(1.0, chunk, out=chunk)
+        else:
+            np.rint(chunk, out=chunk)
+            np.clip(chunk, low, high, out=chunk)
+        chunk /= scale
+
+    if isinstance(data, np.memmap):
+        data.flush()
+    return data
+
+def legacy_bit_depth_conversion(data, bit_depth):
+    """Original truncating 8/16-bit conversion, kept as the benchmark baseline"""
+    if bit_depth == 8:
+        data = np.int8(data * 127)
+        data = data.astype(np.float32) / 127.0
+    elif bit_depth == 16:
+        data = np.int16(data * 32767)
+        data = data.astype(np.float32) / 32767.0
+    return data
 
-def process_audio(input_file, sample_rate, bit_depth):
+def process_audio(input_file, sample_rate, bit_depth, dither=False, noise_shaping=False):
     """Process audio with different sample rate and bit depth"""
     data, sr = sf.read(input_file)
     
@@ -71,15 +409,41 @@ def process_audio(input_file, sample_rate, bit_depth):
         data = signal.resample(data, int(len(data) * sample_rate / sr))
     
     # Apply bit depth conversion
-    if bit_depth == 8:
-        data = np.int8(data * 127)
-        data = data.astype(np.float32) / 127.0
-    elif bit_depth == 16:
-        data = np.int16(data * 32767)
-        data = data.astype(np.float32) / 32767.0
+    quantize(data, bit_depth, dither=dither, noise_shaping=noise_shaping)
 
     return data
 
+def benchmark_quantization(n_samples=10_000_000, bit_depth=16, repeats=3):
+    """Compare throughput (samples/s) and peak memory of quantize() against the legacy conversion"""
+    rng = np.random.default_rng(0)
+    source = rng.uniform(-1.0, 1.0, n_samples).astype(np.float32)
+    # Noise shaping runs sample by sample in Python, so it gets 1% of the samples
+    cases = [
+        ("legacy", lambda d: legacy_bit_depth_conversion(d, bit_depth), n_samples),
+        ("quantize", lambda d: quantize(d, bit_depth), n_samples),
+        ("quantize + dither", lambda d: quantize(d, bit_depth, dither=True, rng=rng), n_samples),
+        ("quantize + noise shaping", lambda d: quantize(d, bit_depth, noise_shaping=True),
+         max(1, n_samples // 100)),
+    ]
+
+    results = {}
+    for name, run, count in cases:
+        best = float('inf')
+        for _ in range(repeats):
+            data = source[:count].copy()
+            started = time.perf_counter()
+            run(data)
+            best = min(best, time.perf_counter() - started)
+        # Separate traced run: tracemalloc slows down the pure-Python noise shaping loop a lot
+        data = source[:count].copy()
+        tracemalloc.start()
+        run(data)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        results[name] = (count / best, peak)
+        print(f"{name:>24}: {count / best / 1e6:8.2f} Msamples/s, peak {peak / 2**20:8.1f} MiB")
+    return results
+
 def calculate_snr(original, processed):
     """Calculate Signal-to-Noise Ratio"""
     min_length = min(len(original), len(processed))
@@ -93,14 +457,14 @@ def calculate_snr(original, processed):
 def main():
     print("1. Record audio")
     print("2. Play audio")
+    print("3. Benchmark bit depth quantization")
     choice = int(input("Choose option: "))
 
     if choice == 1:
         # Record reference audio
-        frames, sr, bits = record_audio()
         reference_file = "reference.wav"
-        save_audio(frames, reference_file, sr, bits)
-        print(f"Reference recording saved as {reference_file}")
+        stats = record_audio_stream(reference_file)
+        print(f"Reference recording saved as {reference_file} (overruns: {stats['overruns']})")
 
         # Process with different parameters
         sample_rates = [8000, 16000, 44100, 48000]
@@ -122,7 +486,12 @@ def main():
         for file in os.listdir():
             if file.endswith(".wav"):
                 print(f"Playing {file}...")
-                play_audio(file)
+                stats = play_audio_stream(file)
+                if stats['underruns']:
+                    print(f"Underruns: {stats['underruns']}")
+
+    elif choice == 3:
+        benchmark_quantization()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,148 @@
+from functools import partial
+
+import numpy as np
+import pyaudio
+import pytest
+import soundfile as sf
+
+from main import FileStream, RingBuffer, play_audio_stream, quantize, record_audio_stream
+
+
+def write_sine(path, seconds, sample_rate=48000):
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    data = (0.5 * np.sin(2 * np.pi * 440 * t) * 32767).astype(np.int16)
+    sf.write(path, data, sample_rate, subtype='PCM_16')
+    return data
+
+
+def test_ring_buffer_wraps_and_counts_drops():
+    ring = RingBuffer(8)
+    assert ring.write(np.arange(6).reshape(-1, 1)) == 6
+    out = np.empty((4, 1), dtype=np.int16)
+    assert ring.read(out) == 4
+    assert ring.write(np.arange(6, 14).reshape(-1, 1)) == 6
+    assert ring.overruns == 1 and ring.dropped == 2
+    out = np.empty((8, 1), dtype=np.int16)
+    assert ring.read(out) == 8
+    assert out[:, 0].tolist() == [4, 5, 6, 7, 8, 9, 10, 11]
+
+
+def test_record_and_play_round_trip_through_file_stream(tmp_path):
+    source = write_sine(tmp_path / "in.wav", 3)
+    recorded = tmp_path / "rec.wav"
+    played = tmp_path / "out.wav"
+
+    ring = RingBuffer(4096)
+    stats = record_audio_stream(
+        recorded, duration=1.5, ring=ring,
+        stream_factory=partial(FileStream, tmp_path / "in.wav", realtime=False, ring=ring))
+    assert stats['frames'] == 72000
+    assert stats['overruns'] == stats['dropped'] == stats['input_overflows'] == 0
+    data, _ = sf.read(recorded, dtype='int16')
+    assert np.array_equal(data, source[:72000])
+
+    for _ in range(5):
+        ring = RingBuffer(4096)
+        stats = play_audio_stream(
+            recorded, ring=ring,
+            stream_factory=partial(FileStream, played, realtime=False, ring=ring))
+        assert stats['frames'] == 72000
+        assert stats['underruns'] == stats['output_underflows'] == 0
+        data, _ = sf.read(played, dtype='int16')
+        assert np.array_equal(data, source[:72000])
+
+
+def test_realtime_recording_stops_at_duration(tmp_path):
+    write_sine(tmp_path / "in.wav", 1)
+    stats = record_audio_stream(
+        tmp_path / "rec.wav", duration=0.2,
+        stream_factory=partial(FileStream, tmp_path / "in.wav"))
+    assert stats['frames'] == 9600
+    assert sf.info(tmp_path / "rec.wav").frames == 9600
+    assert stats['elapsed'] < 1
+
+
+def test_recording_keeps_last_partial_block(tmp_path):
+    source = write_sine(tmp_path / "in.wav", 30000 / 48000)
+    stats = record_audio_stream(
+        tmp_path / "rec.wav", duration=2,
+        stream_factory=partial(FileStream, tmp_path / "in.wav", realtime=False))
+    assert stats['frames'] == 30000
+    data, _ = sf.read(tmp_path / "rec.wav", dtype='int16')
+    assert np.array_equal(data, source)
+
+
+class AbortingStream(FileStream):
+    """Fake output device that aborts after a few callbacks"""
+
+    def _call(self, in_data, frame_count):
+        out_data, flag = super()._call(in_data, frame_count)
+        return out_data, pyaudio.paAbort if len(self.callback_times) >= 6 else flag
+
+
+def test_playback_returns_when_stream_aborts(tmp_path):
+    write_sine(tmp_path / "in.wav", 3)
+    ring = RingBuffer(4096)
+    stats = play_audio_stream(
+        tmp_path / "in.wav", ring=ring,
+        stream_factory=partial(AbortingStream, tmp_path / "out.wav", realtime=False, ring=ring))
+    assert stats['frames'] == 6 * 1024
+    assert stats['underruns'] == 0
+
+
+def test_file_stream_errors_reach_the_caller(tmp_path):
+    write_sine(tmp_path / "in.wav", 1)
+    with pytest.raises(RuntimeError):
+        record_audio_stream(tmp_path / "rec.wav", duration=1,
+                            stream_factory=partial(FileStream, tmp_path / "missing.wav"))
+    with pytest.raises(RuntimeError):
+        play_audio_stream(tmp_path / "in.wav", buffer_frames=4096,
+                          stream_factory=partial(FileStream, tmp_path / "no_dir" / "out.wav"))
+
+
+def test_quantize_clips_to_bit_depth_range():
+    data = np.array([-1.5, -1.0, -0.3, 0.0, 0.3, 0.99999, 1.5])
+    assert quantize(data.copy(), 8).tolist() == [-1.0, -1.0, -0.296875, 0.0, 0.296875, 127 / 128, 127 / 128]
+    q = quantize(data.copy(), 24)
+    assert q.min() == -1.0 and q.max() == 1 - 2.0 ** -23
+    assert quantize(data.copy(), 1).tolist() == [-1.0, -1.0, -1.0, 1.0, 1.0, 1.0, 1.0]
+
+
+def test_quantize_low_bit_depths():
+    data = np.linspace(-1, 1, 9)
+    assert quantize(data.copy(), 1).tolist() == [-1, -1, -1, -1, 1, 1, 1, 1, 1]
+    assert quantize(data.copy(), 2).tolist() == [-1, -1, -0.5, 0, 0, 0, 0.5, 0.5, 0.5]
+
+
+def test_quantize_memmap_in_place(tmp_path):
+    data = np.memmap(tmp_path / "audio.dat", dtype=np.float32, mode='w+', shape=(100000, 2))
+    data[:] = 0.3
+    assert quantize(data, 8, chunk_size=4096) is data
+    reopened = np.memmap(tmp_path / "audio.dat", dtype=np.float32, mode='r', shape=(100000, 2))
+    assert np.all(reopened == np.float32(0.296875))
+
+
+def test_quantize_dither_stays_within_one_lsb():
+    rng = np.random.default_rng(0)
+    data = rng.uniform(-0.9, 0.9, 200000)
+    q = quantize(data.copy(), 8, dither=True, rng=rng, chunk_size=10000)
+    error = (q - data) * 128
+    # +-1 LSB of TPDF dither plus at most half an LSB of rounding
+    assert np.abs(error).max() <= 1.5
+    assert abs(error.mean()) < 0.01
+    assert np.all(q * 128 == np.rint(q * 128))
+
+
+def test_quantize_dither_other_float_precisions():
+    for dtype in (np.float16, np.longdouble):
+        q = quantize(np.full(1000, 0.25, dtype=dtype), 8, dither=True)
+        assert q.dtype == dtype
+        assert np.abs(q.astype(np.float64) - 0.25).max() <= 1.5 / 128
+
+
+def test_quantize_noise_shaping_recovers_after_overload():
+    t = np.arange(2000)
+    data = np.concatenate([np.full(2000, 1.2), 0.3 * np.sin(t / 10)])
+    q = quantize(data.copy(), 8, noise_shaping=True, chunk_size=1000)
+    assert np.all(q[:2000] == 127 / 128)
+    assert np.abs(q[2000:] - data[2000:]).max() <= 1 / 128